@@ -27,6 +27,7 @@ meas_list = 'kb.dcv, kt.dcv, kb.i, kt.i'
 from functions import qtmlab
 meas_dict = qtmlab.generate_meas_dict(globals(), meas_list)
 qtmlab.meas_dict = meas_dict
+qtmlab.finalize_meas_dict()
 qtmlab.dtw = dtw
 #%% Batch commands
 """
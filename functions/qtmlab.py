@@ -3,10 +3,12 @@
 Functions that can be used in measurements within the QTMlab framework.
 
 Available functions:
-    move(device, variable, setpoint, rate)
+    move(device, variable, setpoint, rate, *, move_dt=None, poll_dt=None, tol=None)
     measure()
+    measure_into(out)
+    finalize_meas_dict()
     sweep(device, variable, start, stop, rate, npoints, filename, sweepdev, scale='lin')
-    waitfor(device, variable, setpoint, threshold=0.05, tmin=60)
+    waitfor(device, variable, setpoint, threshold=0.05, tmin=60, *, poll_dt=1)
     record(dt, npoints, filename)
     record_until(dt, filename, device, variable, operator, value, maxnpoints)
     multisweep(sweep_list, npoints, filename)
@@ -22,10 +24,30 @@ University of Twente
 import time
 import numpy as np
 import os
+import sys
+import re
+import queue
+import threading
 import math
 from datetime import datetime
+from functools import partial
+from contextlib import ExitStack
+
+class MoveTimeoutErr(Exception):
+    """
+    A device did not reach its setpoint within the expected time during a
+    move command. Check the device (e.g. for a quench, or whether it is in
+    local mode) before retrying the move.
+    """
+    pass
 
 meas_dict = {}
+# Names of the files in the data directories, per directory (see checkfname)
+_known_files = {}
+# Last setpoint reached by move() per (id(device), variable)
+_last_setpoint = {}
+# Read commands of the measurement dictionary last used by measure()
+_meas_cache = {'md': None, 'nmeas': 0, 'reads': []}
 
 # Global settings
 dt = 0.02           # Move timestep [s]
@@ -35,153 +57,399 @@ dtw = 1             # Wait time before measurement [s]
 if not os.path.isdir('Data'):
     os.mkdir('Data')
 
+# Timer for _precise_sleep: on Linux, a timerfd (CLOCK_MONOTONIC) is used, which
+# is set through ctypes for Python versions without os.timerfd_create.
+_timerfd = None
+_timerfd_settime = None
+if sys.platform.startswith('linux'):
+    try:
+        if hasattr(os, 'timerfd_create'):
+            _timerfd = os.timerfd_create(time.CLOCK_MONOTONIC)
+            _timerfd_settime = lambda period: os.timerfd_settime(_timerfd, initial=period)
+        else:
+            import ctypes
+
+            class _timespec(ctypes.Structure):
+                _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+            class _itimerspec(ctypes.Structure):
+                _fields_ = [('it_interval', _timespec), ('it_value', _timespec)]
+
+            _libc = ctypes.CDLL(None, use_errno=True)
+            _timerfd = _libc.timerfd_create(time.CLOCK_MONOTONIC, 0)
+            if _timerfd < 0:
+                raise OSError(ctypes.get_errno(), 'timerfd_create failed')
+
+            def _timerfd_settime(period):
+                sec = int(period)
+                spec = _itimerspec(_timespec(0, 0), _timespec(sec, int((period - sec) * 1E9)))
+                if _libc.timerfd_settime(_timerfd, 0, ctypes.byref(spec), None) != 0:
+                    raise OSError(ctypes.get_errno(), 'timerfd_settime failed')
+    except (OSError, AttributeError):
+        _timerfd = None
+
+def _precise_sleep(period):
+    """
+    Sleeps for <period> seconds. On Linux, this uses a timerfd, which wakes
+    up more reliably on time than time.sleep. Elsewhere, it uses time.sleep.
+    """
+    # A timerfd set to zero is disarmed and would never fire
+    if period < 1E-6:
+        return
+    if _timerfd is None:
+        time.sleep(period)
+        return
+    _timerfd_settime(period)
+    os.read(_timerfd, 8)
+
 # Filename checker
-def checkfname(filename):
+def invalidate_file_cache():
+    """
+    Clears the cached directory listings of checkfname, such that the
+    directories are scanned again on the next call. Only needed when files
+    are created in the data directory from outside of QTMtoolbox.
+    """
+    _known_files.clear()
+
+def clear_setpoint_cache():
+    """
+    Forgets the setpoints remembered by move(), such that the next move of
+    every device reads its current value again. Needed when a variable was
+    changed by other means than move() (e.g. on the front panel).
+    """
+    _last_setpoint.clear()
+
+def checkfname(filename, _rescan=True):
     """
     This function checks if the to-be-created measurement file already exists.
-    If so, it appends a number. For all successive existing (numbered) files,
-    it raises the counter
-    """
-    append_no = 0;
-    while os.path.isfile(filename):
-        append_no += 1 #Count the number of times the file already existed
-        filename = filename.split('.')
-        if append_no == 1: #The first time the program finds the unedited filename. We save it as the base
-            filename_base = filename[0]
-        filename = filename_base + '_' + str(append_no) +'.' + filename[1] #add "_N" to the filename where N is the number of loop iterations
-        if os.path.isfile(filename) == False: #Only when the newly created filename doesn't exist: inform the user. The whileloop stops.
-            print('The file already exists. Filename changed to: ' + filename)
-    return(filename)
-
-def move(device, variable, setpoint, rate):
+    If so, it appends a number "_N", where N is one higher than the highest
+    number of the existing (numbered) files.
+    The directory is scanned once per session; the names of files created
+    since are added to the cached listing (see invalidate_file_cache).
+    """
+    dirname = os.path.dirname(filename) or '.'
+    if dirname not in _known_files:
+        with os.scandir(dirname) as entries:
+            # normcase: names differing in case only are the same file on Windows
+            _known_files[dirname] = {os.path.normcase(entry.name) for entry in entries}
+    names = _known_files[dirname]
+
+    requested = filename
+    base, ext = os.path.splitext(filename)
+    if os.path.normcase(os.path.basename(filename)) in names:
+        pattern = re.compile(re.escape(os.path.normcase(os.path.basename(base))) + r'_(\d+)'
+                             + re.escape(os.path.normcase(ext)) + '$')
+        append_no = 0
+        for known in names:
+            match = pattern.match(known)
+            if match:
+                append_no = max(append_no, int(match.group(1)))
+        filename = base + '_' + str(append_no + 1) + ext
+
+    if os.path.isfile(filename):
+        if _rescan:
+            # The file may have been created by another program since the
+            # scan, so scan the directory again (once)
+            del _known_files[dirname]
+            return checkfname(requested, _rescan=False)
+        # The listing still does not match the file system (e.g. on a case
+        # insensitive file system), so count up until the name is free
+        append_no = 1
+        filename = base + '_1' + ext
+        while os.path.isfile(filename):
+            append_no += 1
+            filename = base + '_' + str(append_no) + ext
+
+    names.add(os.path.normcase(os.path.basename(filename)))
+    if filename != requested:
+        print('The file already exists. Filename changed to: ' + filename)
+    return filename
+
+def _devtype(device, names):
+    """
+    Returns the first of the class names in <names> that <device> is an
+    instance of (also for subclasses), or None. Classes are matched by name,
+    such that this module does not need to import the (visa based)
+    instrument modules, and both MercuryiPS modules (GPIB, eth) match.
+    """
+    for cls in type(device).__mro__:
+        if cls.__name__ in names:
+            return cls.__name__
+    return None
+
+def _wait_until_reached(read_command, target, tol=1E-3, dt0=None, dt_max=0.2, timeout=60, rate=None):
+    """
+    Polls <read_command> until the returned value is within +/- <tol> of
+    <target>. The poll interval starts at <dt0> (default: dt) and doubles after
+    every miss, up to <dt_max>. If the <rate> at which the device approaches
+    <target> is given, the poll interval is instead a tenth of the remaining
+    ramp time (clipped to <dt0>...<dt_max>), i.e. polling is sparse when far
+    from the target and dense when close to it.
+    Returns True when the target is reached, or False if it was not reached
+    within <timeout> seconds.
+    """
+    if dt0 is None:
+        dt0 = dt
+    delay = dt0
+    deadline = time.monotonic() + timeout
+    # Polls are scheduled relative to the previous poll, such that the time
+    # spent on reading is not added to the poll interval
+    t_poll = time.perf_counter()
+    while time.monotonic() < deadline:
+        t_poll += delay
+        _precise_sleep(t_poll - time.perf_counter())
+        remaining = abs(float(read_command()) - target)
+        if remaining <= tol:
+            return True
+        if rate is None:
+            delay = min(delay * 2, dt_max)
+        else:
+            delay = max(dt0, min(dt_max, remaining / rate / 10))
+    return False
+
+class _DataWriter:
+    """
+    Appends rows to a datafile from a background thread, such that the
+    measurement loop is not delayed by file I/O. Rows (lists of values) are
+    queued by write(); all rows that are queued at once are written and then
+    flushed, such that the file can be plotted live. close() writes the
+    remaining rows and closes the file. Can be used in a with statement.
+    With <flush_every> = k > 1, rows are passed to the thread (and thus appear
+    in the file) in blocks of k rows; with <flush_every> = 0, all rows are
+    written when the writer is closed.
+    """
+    def __init__(self, filename, flush_every=1):
+        self.file = open(filename, 'a', buffering=65536)
+        self.queue = queue.Queue(maxsize=1024)
+        self.flush_every = flush_every
+        self.pending = []
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        fmt = None
+        try:
+            while True:
+                # The queue holds blocks of rows, close() puts None as a
+                # sentinel after the last block
+                blocks = [self.queue.get()]
+                while not self.queue.empty():
+                    blocks.append(self.queue.get_nowait())
+                done = blocks[-1] is None
+                if done:
+                    blocks.pop()
+                rows = [row for block in blocks for row in block]
+                if rows:
+                    # All rows have the same number of columns, so the format
+                    # string is built once
+                    if fmt is None:
+                        fmt = ', '.join(['%.10g'] * len(rows[0])) + '\n'
+                    self.file.write(''.join([fmt % tuple(row) for row in rows]))
+                if done:
+                    return
+                self.file.flush()
+        except Exception as e:
+            self.error = e
+
+    def _put(self, item):
+        # Do not block on a full queue forever: if the thread failed, nothing
+        # drains the queue anymore
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, row):
+        if self.error is not None:
+            raise self.error
+        if self.flush_every == 1:
+            self._put([row])
+            return
+        self.pending.append(row)
+        if self.flush_every and len(self.pending) >= self.flush_every:
+            self._put(self.pending)
+            self.pending = []
+
+    def close(self):
+        try:
+            if self.error is None:
+                if self.pending:
+                    self._put(self.pending)
+                    self.pending = []
+                self._put(None)
+            self.thread.join()
+        finally:
+            self.file.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def move(device, variable, setpoint, rate, *, move_dt=None, poll_dt=None, tol=None):
     """
     The move command moves <variable> of <device> to <setpoint> at <rate>.
     Example: move(KeithBG, dcv, 10, 0.1)
 
+    Optional keyword arguments:
+        move_dt : timestep between setpoints when ramping a device that applies
+                  setpoints instantly (default: dt).
+        poll_dt : shortest interval at which devices that ramp by themselves
+                  (ips120, MercuryiPS) are polled (default: 0.05 s).
+        tol     : margin within which such a device is considered to have
+                  reached its setpoint (default: 1E-4, the magnets' precision).
+    A shorter move_dt or poll_dt gives a smoother ramp or a faster response
+    once the setpoint is reached, but every step or poll is a bus transaction,
+    which costs time and loads the (shared) GPIB bus. For slow devices, a
+    longer interval therefore costs little and frees the bus for others.
+
     Note: a variable can only be moved if its instrument class has both
     write_var and read_var modules.
+    For devices that apply setpoints instantly, the last setpoint reached
+    through move() is remembered, and moving to that same setpoint again
+    returns without any bus traffic. If such a variable is changed by other
+    means than move(), call clear_setpoint_cache().
     """
+    if move_dt is None:
+        move_dt = dt
+    if poll_dt is None:
+        poll_dt = 0.05
+    if tol is None:
+        tol = 1E-4
 
-    # Oxford Magnet Controller - timing issue fix
+    handler = _MOVE_HANDLERS.get(_devtype(device, _MOVE_HANDLERS), _move_generic)
+    handler(device, variable, setpoint, rate, move_dt, poll_dt, tol)
+
+def _move_ips120(device, variable, setpoint, rate, move_dt, poll_dt, tol):
     """
-    For Oxford IPS120-10 Magnet Controllers, timing is a problem.
+    Moves an Oxford IPS120-10 Magnet Controller, for which timing is a problem.
     Sending and receiving data over GPIB takes a considerable amount
     of time. We therefore change the magnet's rate and issue a single set
-    command. Then, we check every once in a while (100 ms delay) if it is
-    already at its setpoint.
+    command. Then, we check every once in a while (between 50 ms and 1 s,
+    depending on the remaining distance) if it is already at its setpoint.
     """
-    #---------------------------------------------------------------------------
-    devtype = str(type(device))[1:-1].split('.')[-1].strip("'")
-    if devtype == 'ips120':
-        read_command = getattr(device, 'read_' + variable)
-        cur_val = float(read_command())
-
-        #Convert rate per second to rate per minute (ips rate is in T/m)
-        ratepm = round(rate * 60, 3)
-        if ratepm >= 0.4:
-            ratepm = 0.4
-        # Don't put rate to zero if move setpoint == current value
-        if ratepm == 0:
-            ratepm = 0.1
-
-        write_rate = getattr(device, 'write_rate')
-        write_rate(ratepm)
+    read_command = getattr(device, 'read_' + variable)
+    cur_val = float(read_command())
 
-        # Magnet's precision = 0.0001, so round setpoint before sending the value
-        setpoint = round(setpoint, 4)
-        write_command = getattr(device, 'write_' + variable)
+    #Convert rate per second to rate per minute (ips rate is in T/m)
+    ratepm = round(rate * 60, 3)
+    if ratepm >= 0.4:
+        ratepm = 0.4
+    # Don't put rate to zero if move setpoint == current value
+    if ratepm == 0:
+        ratepm = 0.1
+
+    write_rate = getattr(device, 'write_rate')
+    write_rate(ratepm)
+
+    write_command = getattr(device, 'write_' + variable)
+    write_command(setpoint)
+
+    # Check if the magnet is really at its setpoint, as the device is very slow.
+    # If the device is still not there after the expected ramp time (plus
+    # some margin), send the setpoint again. Give up after 10 attempts.
+    t_ramp = abs(setpoint - cur_val) / (ratepm / 60)
+    attempts = 1
+    while not _wait_until_reached(read_command, setpoint, tol=tol, dt0=poll_dt, dt_max=1, timeout=t_ramp + 2, rate=ratepm / 60):
+        if attempts == 10:
+            raise MoveTimeoutErr('ips120 did not reach {} after {} attempts'.format(setpoint, attempts))
         write_command(setpoint)
+        attempts += 1
 
-        # Check if the magnet is really at its setpoint, as the device is very slow
-        reached = False
-        cntr = 0
-        while not reached:
-            time.sleep(0.2)
-            cur_val = float(read_command())
-            if round(cur_val, 4) == round(setpoint, 4):
-                reached = True
-            else:
-                cntr += 1
-            # If the device is still not there, send the setpoint again
-            if cntr == 5:
-                time.sleep(0.2)
-                write_command(setpoint)
-
-    #---------------------------------------------------------------------------
-
-    # Oxford MercuryiPS Controller - alternative approach
+def _move_mercury(device, variable, setpoint, rate, move_dt, poll_dt, tol):
     """
-    Since the VRM (even when operated over GPIB/ethernet) also does not move to
-    setpoints instantly, we implement a similar move command as we did for the
-    ips120 power supply.
+    Moves an Oxford MercuryiPS Controller. Since the VRM (even when operated
+    over GPIB/ethernet) also does not move to setpoints instantly, we implement
+    a similar move command as we did for the ips120 power supply.
     Here, we calculate the rate and send this rate and the new setpoint to the
     power supply. We then check whether the magnet's state is "Moving" (i.e. at
     least one of the magnet's axes' state is RTOS (ramp to setpoint) or whether
     the state is "Hold" - only if the state is "Hold", the move command is finished).
 
+    The state is polled between every 50 ms and 1 s, depending on the remaining
+    distance to the setpoint.
+
     Sometimes, the magnet does not move correctly, so when it says RTOS but is
     not changing its setpoint, we set the magnet to HOLD and then try again. This
     is not very nice, but it circumvents the issues for the moment.
 
     Currently, one can only move fvalueX, fvalueY, fvalueZ, but not "vector".
     """
-    #---------------------------------------------------------------------------
-    devtype = str(type(device))[1:-1].split('.')[-1].strip("'")
-    if devtype == 'MercuryiPS':
-        read_command = getattr(device, 'read_' + variable)
-        cur_val = float(read_command())
-
-        ratepm = round(rate * 60, 3)
-        if ratepm >= 0.2:
-            ratepm = 0.2
-        if ratepm == 0:
-            ratepm = 0.1
-
-        # This line really only works for fvalue{X,Y,Z}
-        write_rate = getattr(device, 'write_rate' + variable[-1])
-        write_rate(ratepm)
-
-        write_command = getattr(device, 'write_' + variable)
-        write_command(setpoint)
+    read_command = getattr(device, 'read_' + variable)
+    cur_val = float(read_command())
 
-        #Check if the magnet reached its setpoint
-        reached = False
-        cntr = 0 # Initialise counter
-        while not reached:
-            time.sleep(0.5)
-            state_command = getattr(device, 'read_status')
-            prev_val = float(read_command())
-            cur_state = state_command()
-            # Check if magnet is moving (RTOS) or holding (HOLD)
-            if cur_state == 'HOLD':
-                # Check if field value is same as setpoint (within margin because
-                # of the fluctuations in the given value)
-                new_val = float(read_command())
-                if abs(new_val - setpoint) < 1E-4:
-                    reached = True
-                    time.sleep(1)
-            else:
+    ratepm = round(rate * 60, 3)
+    if ratepm >= 0.2:
+        ratepm = 0.2
+    if ratepm == 0:
+        ratepm = 0.1
+
+    # This line really only works for fvalue{X,Y,Z}
+    write_rate = getattr(device, 'write_rate' + variable[-1])
+    write_rate(ratepm)
+
+    write_command = getattr(device, 'write_' + variable)
+    write_command(setpoint)
+
+    state_command = getattr(device, 'read_status')
+    hold_command = getattr(device, 'hold')
+
+    # Give up if the magnet takes much longer than the expected ramp time
+    t_ramp = abs(setpoint - cur_val) / (ratepm / 60)
+    deadline = time.monotonic() + 10 * t_ramp + 60
+
+    #Check if the magnet reached its setpoint
+    reached = False
+    new_val = cur_val
+    # Value and time at which we last checked if the magnet is moving
+    prev_val = cur_val
+    t_prev = time.monotonic()
+    t_poll = time.perf_counter()
+    while not reached:
+        if time.monotonic() > deadline:
+            raise MoveTimeoutErr('Mercury iPS did not reach {} within {:.0f} s'.format(setpoint, 10 * t_ramp + 60))
+        # Poll sparsely when far from the setpoint, densely when close
+        t_poll += max(poll_dt, min(1, abs(setpoint - new_val) / (ratepm / 60) / 10))
+        _precise_sleep(t_poll - time.perf_counter())
+        cur_state = state_command()
+        new_val = float(read_command())
+        # Check if magnet is moving (RTOS) or holding (HOLD)
+        if cur_state == 'HOLD':
+            # Check if field value is same as setpoint (within margin because
+            # of the fluctuations in the given value)
+            if abs(new_val - setpoint) <= tol:
+                reached = True
+                time.sleep(1)
+        elif time.monotonic() - t_prev >= 10:
+            # Every 10 s, check whether the magnet is still moving
+            if abs(new_val - prev_val) < 1E-4:
+                hold_command()
                 time.sleep(0.5)
-                cntr += 1
-                new_val = float(read_command())
-                if abs(new_val - prev_val) < 1E-4 and cntr == 10:
-                    cntr = 0
-                    hold_command = getattr(device, 'hold')
-                    hold_command()
-                    time.sleep(0.5)
-                    write_command(setpoint)
-                    print('   Mercury iPS: performed "HOLD / RTOS" sequence.')
-                else:
-                    prev_val = new_val
-
-    #---------------------------------------------------------------------------
+                write_command(setpoint)
+                print('   Mercury iPS: performed "HOLD / RTOS" sequence.')
+            prev_val = new_val
+            t_prev = time.monotonic()
 
-    # Devices that can apply a setpoint instantly
+def _move_generic(device, variable, setpoint, rate, move_dt, poll_dt, tol):
     """
-    The script below applies to most devices, which can apply a given setpoint
-    instantly. Here, we can not supply a 'rate' to the device, but we create
-    a linspace of setpoints and push them to the device at a regular interval.
+    Moves any other device. This applies to most devices, which can apply a
+    given setpoint instantly. Here, we can not supply a 'rate' to the device,
+    but we create a ramp of setpoints and push them to the device at a
+    regular interval.
     """
+    # Skip the move (and the read of the current value) when the device is
+    # known to be at this setpoint already, e.g. at the start of an inner sweep
+    key = (id(device), variable)
+    if _last_setpoint.get(key) == setpoint:
+        return
 
     # Get current Value
     read_command = getattr(device, 'read_' + variable)
@@ -189,45 +457,143 @@ def move(device, variable, setpoint, rate):
 
     # Determine number of steps
     Dt = abs(setpoint - cur_val) / rate
-    nSteps = int(round(Dt / dt))
+    nSteps = int(round(Dt / move_dt))
     # Only move when setpoint != curval, i.e. nSteps != 0
     if nSteps != 0:
-        # Create list of setpoints and change setpoint by looping through array
-        move_curve = np.linspace(cur_val, setpoint, nSteps)
-        for i in range(nSteps):
-            write_command = getattr(device, 'write_' + variable)
-            write_command(move_curve[i])
-            time.sleep(dt)
+        # Forget the previous setpoint before writing: if the ramp is
+        # interrupted, the device is somewhere in between
+        _last_setpoint.pop(key, None)
+        # Step the setpoint from the current value, snapping the last step
+        # exactly onto the setpoint
+        #   Step i is scheduled at t0 + i*move_dt, such that the time spent on
+        #   writing (a GPIB transaction) does not slow down the ramp.
+        step = (setpoint - cur_val) / nSteps
+        write_command = getattr(device, 'write_' + variable)
+        t0 = time.perf_counter()
+        for i in range(1, nSteps + 1):
+            write_command(cur_val + i * step if i < nSteps else setpoint)
+            delay = t0 + i*move_dt - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    # Only remember the setpoint once the ramp has finished
+    _last_setpoint[key] = setpoint
+
+# Move handlers of the devices that ramp to a setpoint by themselves, by class
+# name (see _devtype). All other devices are moved by _move_generic.
+_MOVE_HANDLERS = {'ips120': _move_ips120, 'MercuryiPS': _move_mercury}
+
+def _compile_reads(md):
+    """
+    Resolves the read commands of all devices in the measurement dictionary
+    <md>. Returns a list of (index, read_command) tuples that can be passed to
+    _measure(). Sweeps call this once, instead of doing the lookups per point.
+
+    If a device is measured more than once and its instrument class has a
+    module read_batch(vars), which returns the values of all variables in
+    <vars> (e.g. read_batch(['v', 'i']) -> [v, i]), the device is read with a
+    single read_batch call. Its index is then the list of md positions.
+    """
+    # Group the variables of md by device
+    groups = {}
+    for k, name in enumerate(md):
+        dev = md[name]['dev']
+        groups.setdefault(id(dev), (dev, [], []))
+        groups[id(dev)][1].append(k)
+        groups[id(dev)][2].append(md[name]['var'])
+
+    reads = []
+    for dev, index, variables in groups.values():
+        if len(index) > 1 and hasattr(dev, 'read_batch'):
+            reads.append((index, partial(dev.read_batch, variables)))
+        else:
+            for k, var in zip(index, variables):
+                reads.append((k, getattr(dev, 'read_' + var)))
+    return reads
+
+def _measure(reads, out=None):
+    """
+    Measures all read commands in <reads> (as returned by _compile_reads). If
+    a preallocated array <out> is given, the values are stored in (and returned
+    as) <out>, such that sweeps can reuse a single buffer for every point.
+    """
+    if out is None:
+        out = np.empty(sum(1 if type(k) is int else len(k) for k, _ in reads))
+    for k, read_command in reads:
+        if type(k) is int:
+            out[k] = float(read_command())
+        else:
+            out[k] = read_command()
+    return out
+
+def _cached_reads(md):
+    """
+    Returns the read commands of <md>, which are resolved once and cached for
+    the most recently used measurement dictionary. The cache is rebuilt when
+    a different dictionary is used or when entries are added or removed.
+    Note: after changing the device or variable of an existing entry, call
+    finalize_meas_dict() to resolve the read commands again.
+    """
+    if _meas_cache['md'] is not md or _meas_cache['nmeas'] != len(md):
+        _meas_cache['md'] = md
+        _meas_cache['nmeas'] = len(md)
+        _meas_cache['reads'] = _compile_reads(md)
+    return _meas_cache['reads']
 
 def measure(md=None):
     """
     The measure command measures the values of every <device> and <variable>
     as specified in the 'measurement dictionary ', meas_dict.
+    Returns a new array on every call.
     """
     # Trick to make sure that dictionary loading is handled properly at startup
     if md is None:
         md = meas_dict
 
-    # Loop over list of devices
-    data = np.zeros(len(md))
-    i = 0
-    for device in md:
-        # Retrieve and store data
-        meas_command = getattr(md[device]['dev'], 'read_' + md[device]['var'])
-        data[i] = float(meas_command())
-        i += 1
+    return _measure(_cached_reads(md))
+
+def measure_into(out, md=None):
+    """
+    The measure_into command works as measure, but stores the values in the
+    preallocated array <out> (of length len(meas_dict)) instead of allocating
+    a new array. Returns <out>.
+    """
+    if md is None:
+        md = meas_dict
+
+    return _measure(_cached_reads(md), out)
 
-    return data
+def finalize_meas_dict(md=None):
+    """
+    The finalize_meas_dict command resolves the read commands of all devices
+    in the measurement dictionary (default: meas_dict) once. measure() and
+    measure_into() then call these read commands directly, without walking
+    the dictionary.
+    Call it after setting up meas_dict, and again after changing the device
+    or variable of an existing entry. Assigning a new meas_dict or adding or
+    removing entries is detected automatically.
+    """
+    if md is None:
+        md = meas_dict
 
+    _meas_cache['md'] = None
+    _cached_reads(md)
 
-def sweep(device, variable, start, stop, rate, npoints, filename, sweepdev, md=None, scale='lin'):
+def sweep(device, variable, start, stop, rate, npoints, filename, sweepdev, md=None, scale='lin', silent=False, flush_every=1):
     """
     The sweep command sweeps the <variable> of <device>, from <start> to <stop>.
     Sweeping is done at <rate> and <npoints> are recorded to a datafile saved
     as <filename>.
     For measurements, the 'measurement dictionary', meas_dict, is used.
+    Returns the recorded data as an array with rows (setpoint, data).
+    With <silent> = True, the measurements are not logged in the console.
+    The data is written to file after every point, or in blocks of
+    <flush_every> points (0: only at the end of the sweep). Larger blocks
+    cost less time, but the file can not be followed as closely while
+    measuring.
     """
     print('Starting a sweep of "' + sweepdev + '" from ' + str(start) + ' to ' + str(stop) + ' in ' + str(npoints) + ' ('+ str(scale) + ' spacing)' +' steps with rate ' + str(rate) + '.')
+    if silent:
+        print('   Silent mode enabled. Measurements will not be logged in the console.')
 
     # Trick to make sure that dictionary loading is handled properly at startup
     if md is None:
@@ -239,16 +605,13 @@ def sweep(device, variable, start, stop, rate, npoints, filename, sweepdev, md=N
     # Initialise datafile
     filename = checkfname(filename)
 
-    # Create header
-    header = sweepdev
-    # Add device of 'meas_list'
-    for dev in md:
-        header = header + ', ' + dev
+    # Create header, add devices of 'meas_list'
+    header = ', '.join([sweepdev, *md])
     # Write header to file
     with open(filename, 'w') as file:
         dtm = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
         file.write(dtm + '\n')
-        swcmd = 'sweep of ' + sweepdev  + ' from ' + str(start) + ' to ' + str(stop) + ' in ' + str(npoints) + ' steps ('+ str(scale) + ' spacing)' +' with rate ' + str(rate)
+        swcmd = f'sweep of {sweepdev} from {start} to {stop} in {npoints} steps ({scale} spacing) with rate {rate}'
         file.write(swcmd + '\n')
         file.write(header + '\n')
 
@@ -262,47 +625,87 @@ def sweep(device, variable, start, stop, rate, npoints, filename, sweepdev, md=N
     if scale == 'log':
         sweep_curve = np.logspace(np.log10(start), np.log10(stop), npoints)
 
-    # Perform sweep
-    for i in range(npoints):
-        # Move to measurement value
-        print('Sweeping to: {}'.format(sweep_curve[i]))
-        move(device, variable, sweep_curve[i], rate)
-        # Wait, then measure
-        print('   Waiting for measurement...')
-        time.sleep(dtw)
-        print('   Performing measurement.')
-        data = np.hstack((sweep_curve[i], measure()))
-
-        # Add data to file
-        datastr = np.array2string(data, separator=', ')[1:-1].replace('\n','')
-        with open(filename, 'a') as file:
-            file.write(datastr + '\n')
-
-def waitfor(device, variable, setpoint, threshold=0.05, tmin=60):
+    # Resolve read commands once and allocate the output (rows of setpoint, data)
+    reads = _compile_reads(md)
+    results = np.empty((npoints, 1 + len(md)))
+
+    # Perform sweep (the data is written to file by a background thread)
+    with _DataWriter(filename, flush_every) as writer:
+        for i in range(npoints):
+            # Move to measurement value
+            if not silent:
+                print('Sweeping to: {}'.format(sweep_curve[i]))
+            move(device, variable, sweep_curve[i], rate)
+            # Wait, then measure
+            if not silent:
+                print('   Waiting for measurement...')
+            time.sleep(dtw)
+            if not silent:
+                print('   Performing measurement.')
+            row = results[i]
+            row[0] = sweep_curve[i]
+            _measure(reads, row[1:])
+
+            # Add data to file
+            writer.write(row.tolist())
+
+    return results
+
+def waitfor(device, variable, setpoint, threshold=0.05, tmin=60, *, poll_dt=1):
     """
     The waitfor command waits until <variable> of <device> reached
-    <setpoint> within +/- <threshold> for at least <tmin>.
-    Note: <tmin> is in seconds.
+    <setpoint> within +/- <threshold> for at least <tmin>. The value is
+    read every <poll_dt>: a shorter interval detects (in)stability more
+    accurately, a longer interval causes less traffic on the bus.
+    Note: <tmin> and <poll_dt> are in seconds.
     """
     print('Waiting for "'  + variable + '" to be within ' + str(setpoint) + ' +/- ' + str(threshold) + ' for at least ' + str(tmin) + ' seconds.')
-    stable = False
-    t_stable = 0
-    while not stable:
+    read_command = getattr(device, 'read_' + variable)
+    # Start of the period in which the value is within threshold
+    t_stable = None
+    while True:
         # Read value
-        read_command = getattr(device, 'read_' + variable)
         cur_val = float(read_command())
+        now = time.monotonic()
         # Determine if value within threshold
         if abs(cur_val - setpoint) <= threshold:
-            # Add time to counter
-            t_stable += 10
+            if t_stable is None:
+                t_stable = now
+            # Check if the value has been stable for at least tmin
+            if now - t_stable >= tmin:
+                print('The device is stable.')
+                return
+        else:
+            # Reset stable period
+            t_stable = None
+        time.sleep(poll_dt)
+
+def _record_fast(reads, row, dt, npoints, writer):
+    """
+    Tight version of the record loop for small <dt>, used by record(). It does
+    not print anything and binds everything it uses in the loop to local names.
+    <row> is the preallocated buffer for the rows (time, data).
+    Compiling this loop (Cython, numba) would gain little, because the time per
+    point is spent in calls to the Python read commands of the instruments.
+    Returns the number of points that were taken late.
+    """
+    measure = _measure
+    data = row[1:]
+    write = writer.write
+    perf_counter = time.perf_counter
+    sleep = time.sleep
+    nmissed = 0
+    t0 = perf_counter()
+    for i in range(npoints):
+        row[0] = i*dt
+        measure(reads, data)
+        write(row.tolist())
+        delay = t0 + (i+1)*dt - perf_counter()
+        if delay > 0:
+            sleep(delay)
         else:
-            # Reset counter
-            t_stable = 0
-        time.sleep(10)
-        # Check if t_stable > tmin
-        if t_stable >= tmin:
-            stable = True
-            print('The device is stable.')
+            nmissed += 1
+    return nmissed
 
 def record(dt, npoints, filename, append=False, md=None, silent=False):
     """
@@ -325,26 +728,47 @@ def record(dt, npoints, filename, append=False, md=None, silent=False):
         filename = checkfname(filename)
 
         # Build header
-        header = 'time'
-        for dev in md:
-            header = header + ', ' + dev
+        header = ', '.join(['time', *md])
         # Write header to file
         with open(filename, 'w') as file:
             dtm = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
             file.write(dtm + '\n')
-            swcmd = 'record data with dt = ' + str(dt) + ' s for max ' + str(npoints) + ' datapoints'
+            swcmd = f'record data with dt = {dt} s for max {npoints} datapoints'
             file.write(swcmd + '\n')
             file.write(header + '\n')
 
-    # Perform record
-    for i in range(npoints):
-        if not silent:
-            print('   Performing measurement at t = ' + str(i*dt) + ' s.')
-        data = measure()
-        datastr = (str(i*dt) + ', ' + np.array2string(data, separator=', ')[1:-1]).replace('\n', '')
-        with open(filename, 'a') as file:
-            file.write(datastr + '\n')
-        time.sleep(dt)
+    # Resolve read commands once and allocate the row buffer (time, data)
+    reads = _compile_reads(md)
+    row = np.empty(1 + len(md))
+
+    # Perform record (the data is written to file by a background thread,
+    # which writes all rows that piled up in a single batch)
+    #   Measurement i is scheduled at t0 + i*dt, such that the time spent on
+    #   measuring does not add up over the record.
+    nmissed = 0
+    with _DataWriter(filename) as writer:
+        try:
+            if dt < 0.01:
+                # Use the tight loop for high sampling rates
+                print('   Fast mode enabled (dt < 0.01 s). Measurements will not be logged in the console.')
+                nmissed = _record_fast(reads, row, dt, npoints, writer)
+            else:
+                t0 = time.perf_counter()
+                for i in range(npoints):
+                    if not silent:
+                        print('   Performing measurement at t = ' + str(i*dt) + ' s.')
+                    row[0] = i*dt
+                    _measure(reads, row[1:])
+                    writer.write(row.tolist())
+                    delay = t0 + (i+1)*dt - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    else:
+                        nmissed += 1
+        except KeyboardInterrupt:
+            print('Recording aborted by user. The recorded data is saved in ' + filename + '.')
+    if nmissed > 0:
+        print('   Warning: measuring took longer than dt for ' + str(nmissed) + ' points. These points were taken late.')
 
 def record_until(dt, filename, device, variable, operator, value, maxnpoints, md=None):
     """
@@ -363,9 +787,7 @@ def record_until(dt, filename, device, variable, operator, value, maxnpoints, md
     filename = checkfname(filename)
 
     # Build header
-    header = 'time'
-    for dev in md:
-        header = header + ', ' + dev
+    header = ', '.join(['time', *md])
     # Write header to file
     with open(filename, 'w') as file:
         dtm = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
@@ -374,35 +796,37 @@ def record_until(dt, filename, device, variable, operator, value, maxnpoints, md
         file.write(swcmd + '\n')
         file.write(header + '\n')
     
-    reached = False 
-    i = 0      
-    # Perform record
-    while not reached:
-        print('Performing measurement at t = ' + str(i*dt) + ' s.')
-        data = measure()
-        datastr = (str(i*dt) + ', ' + np.array2string(data, separator=', ')[1:-1]).replace('\n', '')
-        with open(filename, 'a') as file:
-            file.write(datastr + '\n')
-        i += 1
-        time.sleep(dt)
-        
-        # Check for given criterion
-        read_command = getattr(device, 'read_' + variable)
-        cur_val = float(read_command())
-        
-        if operator in ['larger', '>']:
-            if cur_val > value:
-                reached = True
-        if operator in ['smaller', '<']:
-            if cur_val < value:
-                reached = True
-        if operator in ['equal', '=', '==']:
-            if cur_val == value:
+    # Resolve read commands once and allocate the measurement buffer
+    reads = _compile_reads(md)
+    out = np.empty(len(md))
+    read_command = getattr(device, 'read_' + variable)
+
+    # Perform record (the data is written to file by a background thread)
+    reached = False
+    i = 0
+    with _DataWriter(filename) as writer:
+        while not reached:
+            print('Performing measurement at t = ' + str(i*dt) + ' s.')
+            writer.write([i*dt] + _measure(reads, out).tolist())
+            i += 1
+            _precise_sleep(dt)
+
+            # Check for given criterion
+            cur_val = float(read_command())
+
+            if operator in ['larger', '>']:
+                if cur_val > value:
+                    reached = True
+            if operator in ['smaller', '<']:
+                if cur_val < value:
+                    reached = True
+            if operator in ['equal', '=', '==']:
+                if cur_val == value:
+                    reached = True
+            if i > maxnpoints:
                 reached = True
-        if i > maxnpoints:
-            reached = True        
-        
-def multisweep(sweep_list, npoints, filename, md=None):
+
+def multisweep(sweep_list, npoints, filename, md=None, silent=False, flush_every=1):
     """
     The multisweep command sweeps multiple variables simultaneously. The sweep list contains
     all variables, along with their parameters, also stored in a list. An example could be
@@ -416,8 +840,11 @@ def multisweep(sweep_list, npoints, filename, md=None):
 
     The command moves all devices to their respective setpoints, takes a single measurement
     and then moves all devices again to their next setpoint.
+    The options <silent> and <flush_every> work as for sweep.
     """
     print('Starting a multisweep.')
+    if silent:
+        print('   Silent mode enabled. Measurements will not be logged in the console.')
 
     if md is None:
         md = meas_dict
@@ -425,14 +852,7 @@ def multisweep(sweep_list, npoints, filename, md=None):
     filename = 'Data/' + filename
     filename = checkfname(filename)
 
-    header = ''
-    for sweepvar in sweep_list:
-        if header == '':
-            header = sweepvar[5]
-        else:
-            header = header + ', ' + sweepvar[5]
-    for dev in md:
-        header = header + ', ' + dev
+    header = ', '.join([sweepvar[5] for sweepvar in sweep_list] + list(md))
     with open(filename, 'w') as file:
         dtm = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
         file.write(dtm + '\n')
@@ -450,36 +870,91 @@ def multisweep(sweep_list, npoints, filename, md=None):
         sweep_curve = np.linspace(sweepvar[2], sweepvar[3], npoints)
         sweep_curve_list.append(sweep_curve)
 
-    # Perform sweep
-    for i in range(npoints):
-        # Move to the measurement values
-        print('   Sweeping all variables. First variable to: {}'.format(sweep_curve_list[0][i]))
-        for j in range(len(sweep_list)):
-            move(sweep_list[j][0], sweep_list[j][1], sweep_curve_list[j][i], sweep_list[j][4])
-        # Wait, then measure
+    # Resolve read commands once and allocate the row buffer (setpoints, data)
+    reads = _compile_reads(md)
+    nsw = len(sweep_list)
+    row = np.empty(nsw + len(md))
+
+    # Perform sweep (the data is written to file by a background thread)
+    with _DataWriter(filename, flush_every) as writer:
+        for i in range(npoints):
+            # Move to the measurement values
+            if not silent:
+                print('   Sweeping all variables. First variable to: {}'.format(sweep_curve_list[0][i]))
+            for j in range(len(sweep_list)):
+                move(sweep_list[j][0], sweep_list[j][1], sweep_curve_list[j][i], sweep_list[j][4])
+            # Wait, then measure
+            if not silent:
+                print('      Waiting for measurement...')
+            time.sleep(dtw)
+            if not silent:
+                print('      Performing measurement.')
+            for j in range(nsw):
+                row[j] = sweep_curve_list[j][i]
+            _measure(reads, row[nsw:])
+
+            # Add data to file
+            writer.write(row.tolist())
+
+def _take_point(writer, reads, row, device2, variable2, rate2, val1, val2, silent):
+    """
+    Takes a single megasweep datapoint: moves <variable2> of <device2> to <val2>,
+    waits, measures and writes the row (<val1>, <val2>, data) to the datafile.
+    <row> is the (preallocated) row of the output array to fill.
+    """
+    # Move device2 to measurement value
+    if not silent:
+        print('   Sweeping to: {}'.format(val2))
+    move(device2, variable2, val2, rate2)
+    # Wait, then measure
+    if not silent:
         print('      Waiting for measurement...')
-        time.sleep(dtw)
+    time.sleep(dtw)
+    if not silent:
         print('      Performing measurement.')
-        data_setp = np.array([])
-        for j in range(len(sweep_list)):
-            data_setp = np.append(data_setp, sweep_curve_list[j][i])
-        data = np.hstack((data_setp, measure()))
+    row[0] = val1
+    row[1] = val2
+    _measure(reads, row[2:])
 
-        # Add data to file
-        datastr = np.array2string(data, separator=', ')[1:-1].replace('\n','')
-        with open(filename, 'a') as file:
-            file.write(datastr + '\n')
+    # Add data to file
+    writer.write(row.tolist())
 
-def megasweep(device1, variable1, start1, stop1, rate1, npoints1, device2, variable2, start2, stop2, rate2, npoints2, filename, sweepdev1, sweepdev2, mode='standard', md=None):
+def _j_indices(mode, npoints2, i):
+    """
+    Returns the indices of the sweep_curve of variable 2 that a megasweep in
+    <mode> measures for the <i>-th value of variable 1:
+        standard:    forward
+        updown:      forward, then back
+        updownsplit: forward, then back (saved to separate files)
+        serpentine:  forward for even i, back for odd i
+    """
+    forward = range(npoints2)
+    reverse = range(npoints2 - 1, -1, -1)
+    if mode == 'standard':
+        return forward
+    if mode in ('updown', 'updownsplit'):
+        return [*forward, *reverse]
+    if mode == 'serpentine':
+        return forward if (i & 1) == 0 else reverse
+    raise ValueError('Unknown megasweep mode: ' + str(mode))
+
+def megasweep(device1, variable1, start1, stop1, rate1, npoints1, device2, variable2, start2, stop2, rate2, npoints2, filename, sweepdev1, sweepdev2, mode='standard', md=None, silent=False, flush_every=1):
     """
     The megasweep command sweeps two variables. Variable 1 is the "slow" variable.
     For every datapoint of variable 1, a sweep of variable 2 ("fast" variable) is performed.
     The syntax for both variables is <device>, <variable>, <start>, <stop>, <rate>, <npoints>.
     For measurements, the 'measurement dictionary', meas_dict, is used.
+    Returns the recorded data as an array with rows (setpoint1, setpoint2, data),
+    in the order in which they were measured.
+    The options <silent> and <flush_every> work as for sweep.
     """
+    if mode not in ('standard', 'updown', 'updownsplit', 'serpentine'):
+        raise ValueError('Unknown megasweep mode: ' + str(mode))
     print('Starting a "' + mode + '" megasweep of the following variables:')
     print('1: "' + variable1 + '" from ' + str(start1) + ' to ' + str(stop1) + ' in ' + str(npoints1) + ' steps with rate ' + str(rate1))
     print('2: "' + variable2 + '" from ' + str(start2) + ' to ' + str(stop2) + ' in ' + str(npoints2) + ' steps with rate ' + str(rate2))
+    if silent:
+        print('   Silent mode enabled. Measurements will not be logged in the console.')
 
     # Trick to make sure that dictionary loading is handled properly at startup
     if md is None:
@@ -491,16 +966,14 @@ def megasweep(device1, variable1, start1, stop1, rate1, npoints1, device2, varia
     # Initialise datafile
     filename = checkfname(filename)
 
-    # Create header
-    header = sweepdev1 + ', ' + sweepdev2
-    # Add device of 'meas_list'
-    for dev in md:
-        header = header + ', ' + dev
+    # Create header, add devices of 'meas_list'
+    header = ', '.join([sweepdev1, sweepdev2, *md])
+    swcmd = (f'Megasweep of (1) {sweepdev1} from {start1} to {stop1} in {npoints1} steps with rate {rate1}'
+             f' and (2) {sweepdev2} from {start2} to {stop2} in {npoints2} steps with rate {rate2}')
     # Write header to file
     with open(filename, 'w') as file:
         dtm = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
         file.write(dtm + '\n')
-        swcmd = 'Megasweep of (1)' + sweepdev1  + ' from ' + str(start1) + ' to ' + str(stop1) + ' in ' + str(npoints1)  +' steps with rate ' + str(rate1) + 'and (2) ' + sweepdev2  + ' from ' + str(start2) + ' to ' + str(stop2) + ' in ' + str(npoints2)  +' steps with rate ' + str(rate2)
         file.write(swcmd + '\n')
         file.write(header + '\n')
 
@@ -514,130 +987,45 @@ def megasweep(device1, variable1, start1, stop1, rate1, npoints1, device2, varia
     sweep_curve1 = np.linspace(start1, stop1, npoints1)
     sweep_curve2 = np.linspace(start2, stop2, npoints2)
 
-    if mode=='standard':
-        for i in range(npoints1):
-            # Move device1 to value1
-            print('Measuring for device 1 at {}'.format(sweep_curve1[i]))
-            move(device1, variable1, sweep_curve1[i], rate1)
-            # Sweep variable2
-            for j in range(npoints2):
-                # Move device2 to measurement value
-                print('   Sweeping to: {}'.format(sweep_curve2[j]))
-                move(device2, variable2, sweep_curve2[j], rate2)
-                # Wait, then measure
-                print('      Waiting for measurement...')
-                time.sleep(dtw)
-                print('      Performing measurement.')
-                data = np.hstack((sweep_curve1[i], sweep_curve2[j], measure()))
-
-                #Add data to file
-                datastr = np.array2string(data, separator=', ')[1:-1].replace('\n','')
-                with open(filename, 'a') as file:
-                    file.write(datastr + '\n')
+    # Resolve read commands once and allocate the output (rows of setpoints, data),
+    # the updown modes measure every value of variable2 twice
+    reads = _compile_reads(md)
+    nrows = npoints1 * npoints2 * (2 if mode in ('updown', 'updownsplit') else 1)
+    results = np.empty((nrows, 2 + len(md)))
+    rows = iter(results)
 
-    elif mode=='updown':
-        for i in range(npoints1):
-            # Move device1 to value1
-            print('Measuring for device 1 at {}'.format(sweep_curve1[i]))
-            move(device1, variable1, sweep_curve1[i], rate1)
-            # Sweep variable2
-            #   We create a linspace that replaces the range: the linspace goes back and forth
-            sweep_curve2ud = np.hstack((sweep_curve2, sweep_curve2[::-1]))
-            for j in range(npoints2*2):
-                # Move device2 to measurement value
-                print('   Sweeping to: {}'.format(sweep_curve2ud[j]))
-                move(device2, variable2, sweep_curve2ud[j], rate2)
-                # Wait, then measure
-                print('      Waiting for measurement...')
-                time.sleep(dtw)
-                print('      Performing measurement.')
-                data = np.hstack((sweep_curve1[i], sweep_curve2ud[j], measure()))
-
-                #Add data to file
-                datastr = np.array2string(data, separator=', ')[1:-1].replace('\n','')
-                with open(filename, 'a') as file:
-                    file.write(datastr + '\n')
-
-    elif mode=='updownsplit':
+    if mode=='updownsplit':
+        # We split the file in the "up" and "down" part of the updown sweep
         filename2 = filename[:-4] + '_dir2.csv'
         with open(filename2, 'w') as file:
             dtm = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
             file.write(dtm + '\n')
-            swcmd = 'Megasweep of (1)' + sweepdev1  + ' from ' + str(start1) + ' to ' + str(stop1) + ' in ' + str(npoints1)  +' steps with rate ' + str(rate1) + 'and (2) ' + sweepdev2  + ' from ' + str(start2) + ' to ' + str(stop2) + ' in ' + str(npoints2)  +' steps with rate ' + str(rate2)
             file.write(swcmd + '\n')
             file.write(header + '\n')
-        
-        for i in range(npoints1):
-            # Move device1 to value1
-            print('Measuring for device 1 at {}'.format(sweep_curve1[i]))
-            move(device1, variable1, sweep_curve1[i], rate1)
-            time.sleep(5*dtw)
-            # Sweep variable2
-            #   We create a linspace that replaces the range: the linspace goes back and forth
-            sweep_curve2ud = np.hstack((sweep_curve2, sweep_curve2[::-1]))
-            for j in range(npoints2*2):
-                # Move device2 to measurement value
-                print('   Sweeping to: {}'.format(sweep_curve2ud[j]))
-                move(device2, variable2, sweep_curve2ud[j], rate2)
-                # Wait, then measure
-                print('      Waiting for measurement...')
-                time.sleep(dtw)
-                print('      Performing measurement.')
-                data = np.hstack((sweep_curve1[i], sweep_curve2ud[j], measure()))
-                
-                #Add data to file
-                # We split the file in the "up" and "down" part of the updown sweep
-                datastr = np.array2string(data, separator=', ')[1:-1].replace('\n','')
-                if j < npoints2:
-                    with open(filename, 'a') as file:
-                        file.write(datastr + '\n')
-                else:
-                    with open(filename2, 'a') as file:
-                        file.write(datastr + '\n')
-                    
-    elif mode=='serpentine':
-        z = 0
+
+    # The order of variable2 only depends on whether i is even or odd, so the
+    # index sequences (a list of 2*npoints2 indices for updown) are built once
+    j_seqs = (_j_indices(mode, npoints2, 0), _j_indices(mode, npoints2, 1))
+
+    with ExitStack() as stack:
+        writer1 = stack.enter_context(_DataWriter(filename, flush_every))
+        writer2 = stack.enter_context(_DataWriter(filename2, flush_every)) if mode=='updownsplit' else writer1
         for i in range(npoints1):
-            z += 1
             # Move device1 to value1
-            print('Measuring for device 1 at {}'.format(sweep_curve1[i]))
+            if not silent:
+                print('Measuring for device 1 at {}'.format(sweep_curve1[i]))
             move(device1, variable1, sweep_curve1[i], rate1)
-            # Sweep variable2
-            if (z % 2) == 1:
-                for j in range(npoints2):
-                    # Move device2 to measurement value
-                    print('   Sweeping to: {}'.format(sweep_curve2[j]))
-                    move(device2, variable2, sweep_curve2[j], rate2)
-                    # Wait, then measure
-                    print('      Waiting for measurement...')
-                    time.sleep(dtw)
-                    print('      Performing measurement.')
-                    data = np.hstack((sweep_curve1[i], sweep_curve2[j], measure()))
-
-                    #Add data to file
-                    datastr = np.array2string(data, separator=', ')[1:-1].replace('\n','')
-                    with open(filename, 'a') as file:
-                        file.write(datastr + '\n')
-
-            if (z % 2) == 0:
-                for j in range(npoints2):
-                    # Move device2 to measurement value
-                    #  Here, we take -j to reverse the direction of the sweep.
-                    print('   Sweeping to: {}'.format(sweep_curve2[-(j+1)]))
-                    move(device2, variable2, sweep_curve2[-(j+1)], rate2)
-                    # Wait, then measure
-                    print('      Waiting for measurement...')
-                    time.sleep(dtw)
-                    print('      Performing measurement.')
-                    data = np.hstack((sweep_curve1[i], sweep_curve2[-(j+1)], measure()))
-
-                    #Add data to file
-                    datastr = np.array2string(data, separator=', ')[1:-1].replace('\n','')
-                    with open(filename, 'a') as file:
-                        file.write(datastr + '\n')
+            if mode=='updownsplit':
+                time.sleep(5*dtw)
+            # Sweep variable2, the "down" part of an updown sweep goes to writer2
+            # (which is writer1, unless the file is split)
+            for n, j in enumerate(j_seqs[i & 1]):
+                writer = writer1 if n < npoints2 else writer2
+                _take_point(writer, reads, next(rows), device2, variable2, rate2, sweep_curve1[i], sweep_curve2[j], silent)
 
+    return results
 
-def multimegasweep(sweep_list1, sweep_list2, npoints1, npoints2, filename, md=None):
+def multimegasweep(sweep_list1, sweep_list2, npoints1, npoints2, filename, md=None, silent=False, flush_every=1):
     """
     The multimegasweep combines the two-axis measurements of the megasweep with the possibility
     of the multisweep to sweep multiple variables simultaneously. Both megasweep axes hold a
@@ -656,8 +1044,11 @@ def multimegasweep(sweep_list1, sweep_list2, npoints1, npoints2, filename, md=No
     perform a single measurement.
 
     Regarding the megasweep: only the 'standard' mode is implemented below.
+    The options <silent> and <flush_every> work as for sweep.
     """
     print('Starting a multimegasweep.')
+    if silent:
+        print('   Silent mode enabled. Measurements will not be logged in the console.')
 
     if md is None:
         md = meas_dict
@@ -666,16 +1057,7 @@ def multimegasweep(sweep_list1, sweep_list2, npoints1, npoints2, filename, md=No
     filename = checkfname(filename)
 
     # Construct header
-    header = ''
-    for sweepvar in sweep_list1:
-        if header == '':
-            header = sweepvar[5]
-        else:
-            header = header + ', ' + sweepvar[5]
-    for sweepvar in sweep_list2:
-        header = header + ', ' + sweepvar[5]
-    for dev in md:
-        header = header + ', ' + dev
+    header = ', '.join([sweepvar[5] for sweepvar in sweep_list1] + [sweepvar[5] for sweepvar in sweep_list2] + list(md))
     with open(filename, 'w') as file:
         dtm = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
         file.write(dtm + '\n')
@@ -696,42 +1078,51 @@ def multimegasweep(sweep_list1, sweep_list2, npoints1, npoints2, filename, md=No
     for sweepvar in sweep_list1:
         sweep_curve = np.linspace(sweepvar[2], sweepvar[3], npoints1)
         sweep_curve_list1.append(sweep_curve)
-    print(sweep_curve_list1)
+    if not silent:
+        print(sweep_curve_list1)
     sweep_curve_list2 = []
     for sweepvar in sweep_list2:
         sweep_curve = np.linspace(sweepvar[2], sweepvar[3], npoints2)
         sweep_curve_list2.append(sweep_curve)
 
-    # --- Perform megasweep ---
-    # Sweep slow axis
-    for i in range(npoints1):
-        # Move to the measurement values
-        print('   Sweeping all "list1" variables. First variable to: {}'.format(sweep_curve_list1[0][i]))
-        for j in range(len(sweep_list1)):
-            move(sweep_list1[j][0], sweep_list1[j][1], sweep_curve_list1[j][i], sweep_list1[j][4])
+    # Resolve read commands once and allocate the row buffer (setpoints1, setpoints2, data)
+    reads = _compile_reads(md)
+    nsw1 = len(sweep_list1)
+    nsw2 = len(sweep_list2)
+    row = np.empty(nsw1 + nsw2 + len(md))
 
-        # Sweep fast axis
-        for k in range(npoints2):
+    # --- Perform megasweep --- (the data is written to file by a background thread)
+    with _DataWriter(filename, flush_every) as writer:
+        # Sweep slow axis
+        for i in range(npoints1):
             # Move to the measurement values
-            print('   Sweeping all "list2" variables. First variable to: {}'.format(sweep_curve_list2[0][k]))
-            for l in range(len(sweep_list2)):
-                move(sweep_list2[l][0], sweep_list2[l][1], sweep_curve_list2[l][k], sweep_list2[l][4])
-            # Wait, then measure
-            print('      Waiting for measurement...')
-            time.sleep(dtw)
-            print('      Performing measurement.')
-            
-            data_setp = np.array([])
-            for m in range(len(sweep_list1)):
-                data_setp = np.append(data_setp, sweep_curve_list1[m][i])
-            for n in range(len(sweep_list2)):
-                data_setp = np.append(data_setp, sweep_curve_list2[n][k])
-            data = np.hstack((data_setp, measure()))
-
-            #Add data to file
-            datastr = np.array2string(data, separator=', ')[1:-1].replace('\n','')
-            with open(filename, 'a') as file:
-                file.write(datastr + '\n')
+            if not silent:
+                print('   Sweeping all "list1" variables. First variable to: {}'.format(sweep_curve_list1[0][i]))
+            for j in range(len(sweep_list1)):
+                move(sweep_list1[j][0], sweep_list1[j][1], sweep_curve_list1[j][i], sweep_list1[j][4])
+
+            # Sweep fast axis
+            for k in range(npoints2):
+                # Move to the measurement values
+                if not silent:
+                    print('   Sweeping all "list2" variables. First variable to: {}'.format(sweep_curve_list2[0][k]))
+                for l in range(len(sweep_list2)):
+                    move(sweep_list2[l][0], sweep_list2[l][1], sweep_curve_list2[l][k], sweep_list2[l][4])
+                # Wait, then measure
+                if not silent:
+                    print('      Waiting for measurement...')
+                time.sleep(dtw)
+                if not silent:
+                    print('      Performing measurement.')
+
+                for m in range(nsw1):
+                    row[m] = sweep_curve_list1[m][i]
+                for n in range(nsw2):
+                    row[nsw1 + n] = sweep_curve_list2[n][k]
+                _measure(reads, row[nsw1 + nsw2:])
+
+                #Add data to file
+                writer.write(row.tolist())
 
 def generate_meas_dict(globals_dict, meas_list):
     """
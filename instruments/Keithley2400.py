@@ -72,6 +72,19 @@ class Keithley2400:
         resp = str(self.visa.query('READ?').strip('\n'))
         val = float(resp.split(',')[0])
         return val
+
+    def read_batch(self, vars):
+        # A single READ? returns both v and i, so query it only once
+        vals = []
+        resp = None
+        for var in vars:
+            if var in ['v', 'i']:
+                if resp is None:
+                    resp = str(self.visa.query('READ?').strip('\n')).split(',')
+                vals.append(float(resp[0 if var == 'v' else 1]))
+            else:
+                vals.append(getattr(self, 'read_' + var)())
+        return vals
         
     def write_Vrange(self, val):
         if val in ['MAX', 'max', 'maximum', '210']:
@@ -50,7 +50,8 @@ class ips120:
         return resp
 
     def write_fvalue(self, val):
-        fval = float(val)
+        # Magnet's precision = 0.0001, so round setpoint before sending the value
+        fval = round(float(val), 4)
         self.visa.query('J ' + str(fval))
         # This only sets the field, but does not actually tell the magnet to go there. Thus:
         self.visa.query('A 1')
@@ -59,6 +59,23 @@ class sr830:
         resp = float(self.visa.query('OUTP?4').strip('\n').strip('\r'))
         return resp
 
+    def read_batch(self, vars):
+        # SNAP? reads x, y, r and theta at the same instant in a single query
+        snap = {'x': '1', 'y': '2', 'r': '3', 'theta': '4'}
+        snapvars = list(dict.fromkeys([var for var in vars if var in snap]))
+        if len(snapvars) >= 2:
+            resp = self.visa.query('SNAP? ' + ','.join([snap[var] for var in snapvars])).strip('\n').strip('\r')
+            snapvals = dict(zip(snapvars, [float(val) for val in resp.split(',')]))
+        else:
+            snapvals = {}
+        vals = []
+        for var in vars:
+            if var in snapvals:
+                vals.append(snapvals[var])
+            else:
+                vals.append(getattr(self, 'read_' + var)())
+        return vals
+
     def read_freq(self):
         resp = float(self.visa.query('FREQ?').strip('\n').strip('\r'))
         return resp